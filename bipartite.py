@@ -1,15 +1,175 @@
+import itertools
+import logging
 import time
-from collections import Counter
-from functools import cache
 from typing import Optional, Union
 
-import community as community_louvain  # type: ignore
 import networkx as nx  # type: ignore
+import numpy as np
 import pandas as pd  # type: ignore
-from networkx.algorithms import bipartite  # type: ignore
+import scipy.sparse as sp  # type: ignore
+
+try:
+    import igraph as ig  # type: ignore
+    import leidenalg  # type: ignore
+except ImportError:  # Fall back to python-louvain
+    ig = None
+    leidenalg = None
+
+try:
+    import community as community_louvain  # type: ignore
+except ImportError:
+    community_louvain = None
+
+try:
+    from numba import (  # type: ignore
+        get_num_threads,
+        get_thread_id,
+        njit,
+        parallel_chunksize,
+        prange,
+    )
+except ImportError:  # Fall back to scipy's sparse product
+    njit = None
+    prange = range
+
+logger = logging.getLogger(__name__)
+
+
+def _count_projection(indptr, indices, t_indptr, t_indices, n_threads):
+    """Counts the distinct two-hop neighbors of each row of a CSR pattern"""
+    n = len(indptr) - 1
+    counts = np.zeros(n, dtype=np.int64)
+    # Scratch space is per thread rather than per block of rows, so rows can be
+    # handed out dynamically when degrees are skewed
+    markers = np.full((n_threads, n), -1, dtype=np.int64)
+    for i in prange(n):
+        marker = markers[get_thread_id()]
+        for k in indices[indptr[i] : indptr[i + 1]]:
+            for j in t_indices[t_indptr[k] : t_indptr[k + 1]]:
+                if j != i and marker[j] != i:
+                    marker[j] = i
+                    counts[i] += 1
+    return counts
+
+
+def _fill_projection(indptr, indices, t_indptr, t_indices, out_indptr, n_threads):
+    """Fills the columns and shared-neighbor counts of each projected row"""
+    n = len(indptr) - 1
+    out_indices = np.empty(out_indptr[-1], dtype=np.int64)
+    out_data = np.empty(out_indptr[-1], dtype=np.int64)
+    accumulators = np.zeros((n_threads, n), dtype=np.int64)
+    for i in prange(n):
+        acc = accumulators[get_thread_id()]
+        start = out_indptr[i]
+        nnz = 0
+        for k in indices[indptr[i] : indptr[i + 1]]:
+            for j in t_indices[t_indptr[k] : t_indptr[k + 1]]:
+                if j != i:
+                    if acc[j] == 0:
+                        out_indices[start + nnz] = j
+                        nnz += 1
+                    acc[j] += 1
+        for p in range(start, start + nnz):
+            out_data[p] = acc[out_indices[p]]
+            acc[out_indices[p]] = 0
+    return out_indices, out_data
+
+
+if njit is not None:
+    _count_projection = njit(parallel=True, cache=True)(_count_projection)
+    _fill_projection = njit(parallel=True, cache=True)(_fill_projection)
+
+
+def _numba_projection(B: sp.csr_matrix, chunk_size: int = 64) -> sp.csr_matrix:
+    """Runs the projection kernels, handing out rows chunk_size at a time"""
+    B = B.tocsr()
+    Bt = B.T.tocsr()
+    n = B.shape[0]
+    n_threads = get_num_threads()
+    with parallel_chunksize(chunk_size):
+        counts = _count_projection(
+            B.indptr, B.indices, Bt.indptr, Bt.indices, n_threads
+        )
+        out_indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(counts, out=out_indptr[1:])
+        out_indices, out_data = _fill_projection(
+            B.indptr, B.indices, Bt.indptr, Bt.indices, out_indptr, n_threads
+        )
+    W = sp.csr_matrix((out_data, out_indices, out_indptr), shape=(n, n))
+    W.sort_indices()
+    return W
+
+
+def _weighted_projection(B: sp.csr_matrix) -> sp.csr_matrix:
+    """Projects a biadjacency matrix onto its rows.
+
+    Two rows are connected with weight equal to their number of shared
+    neighbors, matching networkx's weighted_projected_graph. Uses the parallel
+    numba kernels when numba has more than one thread, otherwise scipy's
+    sparse product.
+    """
+    if njit is not None and get_num_threads() > 1:
+        return _numba_projection(B)
+
+    B = B.astype(bool).astype(np.int64)
+    W = (B @ B.T).tocsr()
+    W.setdiag(0)
+    W.eliminate_zeros()
+    return W
+
+
+def _to_igraph(W: sp.csr_matrix) -> "ig.Graph":
+    """Converts a symmetric weighted adjacency matrix to an igraph graph"""
+    upper = sp.triu(W, k=1).tocoo()
+    return ig.Graph(
+        n=W.shape[0],
+        edges=list(zip(upper.row.tolist(), upper.col.tolist())),
+        edge_attrs={"weight": upper.data.tolist()},
+    )
+
+
+def _partition(W: sp.csr_matrix, resolution: float) -> tuple[np.ndarray, float]:
+    """Partitions the rows of a weighted adjacency matrix.
+
+    Uses leidenalg when available, otherwise python-louvain. Returns the
+    community of each row and the modularity of the resulting partition,
+    which is NaN when the graph has no edges.
+    """
+    two_m = W.data.sum()
+    if leidenalg is not None:
+        part = leidenalg.find_partition(
+            _to_igraph(W),
+            leidenalg.RBConfigurationVertexPartition,
+            weights="weight",
+            resolution_parameter=resolution,
+        )
+        # At resolution 1 the RB quality is the modularity scaled by 2m, and is
+        # computed from the per-community totals rather than the edges
+        mod = part.quality(resolution_parameter=1.0) / two_m if two_m else np.nan
+        return np.asarray(part.membership), mod
+    if community_louvain is None:
+        raise ImportError("Partitioning requires leidenalg and igraph, or python-louvain")
+    partition = community_louvain.best_partition(
+        nx.from_scipy_sparse_array(W, edge_attribute="weight"),
+        weight="weight",
+        resolution=resolution,
+    )
+    membership = np.array([partition[node] for node in range(W.shape[0])])
+    return membership, _modularity(W, membership) if two_m else np.nan
+
+
+def _modularity(W: sp.csr_matrix, membership: np.ndarray) -> float:
+    """Newman modularity of a partition of a symmetric weighted adjacency matrix"""
+    edges = W.tocoo()
+    two_m = edges.data.sum()
+    if two_m == 0:
+        raise ValueError("A graph without link has an undefined modularity")
+    internal = edges.data[membership[edges.row] == membership[edges.col]].sum()
+    strength = np.asarray(W.sum(axis=1)).ravel()
+    totals = np.bincount(membership, weights=strength)
+    return internal / two_m - np.square(totals).sum() / two_m**2
 
 
-# TODO: Convert debug outputs to logger and allow levels of debug outputs
 class BipartiteCommunity:
     """Represents a weighted bipartite community.
 
@@ -21,6 +181,12 @@ class BipartiteCommunity:
     Note: You cannot specify a min_user_degree AND a min_item_degree at
     the same time. This results in a circular dependency.
 
+    Rows with a missing user_key or item_key are dropped.
+
+    The dataframe is kept by reference rather than copied: get_df() reads the
+    kept rows from it, so modifying it in place afterwards changes what
+    get_df() returns.
+
     Parameters:
         df: DataFrame representing an edge list
         user_key: Column name containing the user partite set
@@ -38,118 +204,254 @@ class BipartiteCommunity:
         min_item_degree: Optional[int] = 10,
     ):
         # 1. Init variables
-        print("Initializing...")
-        self._df = df.copy()
-        self._G = nx.Graph()
+        logger.debug("Initializing...")
+        self._source = df
+        # Only the partite keys are needed; the positional index maps back to df.
+        # Categorical keys let the groupby/factorize below work on integer codes.
+        self._df = df[[user_key, item_key]].reset_index(drop=True).astype("category")
         self.user_key = user_key
         self.item_key = item_key
+        self.clear_cache()
 
         # 2. Apply min_degree filters on dataframe
-        print("Filtering dataframe...")
+        logger.debug("Filtering dataframe...")
+        # Missing keys would be factorized to -1; they are not nodes
+        self._df = self._df.dropna(subset=[user_key, item_key])
         if min_user_degree and min_item_degree:
             raise Exception("See docstring: Illegal settings")
         elif min_user_degree:
-            counts = self._df[user_key].value_counts()
-            self._df = self._df.loc[
-                self._df[user_key].isin(counts[counts >= min_user_degree].index), :
-            ]
+            degree = self._df.groupby(user_key, observed=True)[user_key].transform(
+                "size"
+            )
+            self._df = self._df.loc[degree >= min_user_degree, :]
         elif min_item_degree:
-            counts = self._df[item_key].value_counts()
-            self._df = self._df.loc[
-                self._df[item_key].isin(counts[counts >= min_item_degree].index), :
-            ]
-
-        # 3. Create graph from the filtered nodes
-        print("Adding nodes...")
-        self.user_degree: dict[Union[int, str], int] = Counter(self._df[user_key])
-        self.item_degree: dict[Union[int, str], int] = Counter(self._df[item_key])
-        user_nodes = [
-            (user, {"origin": "user", "degree": degree})
-            for user, degree in self.user_degree.items()
-        ]
-        item_nodes = [
-            (item, {"origin": "item", "degree": degree})
-            for item, degree in self.item_degree.items()
-        ]
-        self._G.add_nodes_from(user_nodes + item_nodes)
-
-        # 4. Add weighted edges based on filtered nodes
-        print("Adding edges...")
-        edge_weights = Counter(list(zip(self._df[user_key], self._df[item_key])))
-        edge_list = [
-            (user, item, weight) for (user, item), weight in edge_weights.items()
-        ]
-        self._G.add_weighted_edges_from(edge_list)
-        print("Completed.\n")
-
-    @cache
-    def project_onto_items(self) -> nx.Graph:
-        print("Starting weighted projection...")
-        start = time.time()
-        projected = bipartite.weighted_projected_graph(
-            self._G, set(self._df[self.item_key])
+            degree = self._df.groupby(item_key, observed=True)[item_key].transform(
+                "size"
+            )
+            self._df = self._df.loc[degree >= min_item_degree, :]
+
+        # 3. Encode both partite sets as contiguous integer codes
+        logger.debug("Encoding keys...")
+        users = self._df[user_key].cat.remove_unused_categories()
+        items = self._df[item_key].cat.remove_unused_categories()
+        u_codes = users.cat.codes.to_numpy().astype(np.int32)
+        self._i_codes = items.cat.codes.to_numpy().astype(np.int32)
+        self._u_labels = users.cat.categories.to_numpy()
+        self._i_labels = items.cat.categories.to_numpy()
+
+        # 4. Compute node degrees
+        logger.debug("Computing degrees...")
+        self.user_degree_arr = np.bincount(u_codes, minlength=len(self._u_labels))
+        self.item_degree_arr = np.bincount(
+            self._i_codes, minlength=len(self._i_labels)
+        )
+
+        # 5. Build the sparse biadjacency matrix (users x items) of edge weights
+        logger.debug("Building biadjacency matrix...")
+        edges = (
+            pd.DataFrame({"user": u_codes, "item": self._i_codes})
+            .groupby(["user", "item"], sort=False)
+            .size()
         )
-        print(f"Finished weighted projection in {time.time() - start}\n")
-        return projected
-
-    @cache
-    def project_onto_users(self) -> nx.Graph:
-        print("Starting weighted projection...")
-        start = time.time()
-        projected = bipartite.weighted_projected_graph(
-            self._G, set(self._df[self.user_key])
+        self._B = sp.csr_matrix(
+            (
+                edges.to_numpy(),
+                (
+                    edges.index.get_level_values("user").to_numpy(),
+                    edges.index.get_level_values("item").to_numpy(),
+                ),
+            ),
+            shape=(len(self._u_labels), len(self._i_labels)),
         )
-        print(f"Finished weighted projection in {time.time() - start}\n")
-        return projected
+        logger.debug("Completed.")
+
+    def filter_items(self, min_degree: Optional[int]) -> "BipartiteCommunity":
+        """Returns a new community without items of lower degree than min_degree.
+
+        A min_degree of None or 0 keeps every item. For a community built
+        without degree filters, this is equivalent to re-initializing from the
+        same dataframe with min_item_degree=min_degree, but slices the
+        biadjacency matrix instead of rebuilding it.
+        """
+        if min_degree:
+            keep_items = self.item_degree_arr >= min_degree
+        else:
+            keep_items = np.ones(len(self._i_labels), dtype=bool)
+        B = self._B[:, keep_items]
+        keep_users = np.diff(B.indptr) > 0
+        keep_rows = keep_items[self._i_codes]
+        new_item_codes = (np.cumsum(keep_items) - 1).astype(np.int32)
+
+        bc = BipartiteCommunity.__new__(BipartiteCommunity)
+        bc._source = self._source
+        bc._df = self._df.loc[keep_rows, :]
+        bc.user_key = self.user_key
+        bc.item_key = self.item_key
+        bc._i_codes = new_item_codes[self._i_codes[keep_rows]]
+        bc._u_labels = self._u_labels[keep_users]
+        bc._i_labels = self._i_labels[keep_items]
+        bc._B = B[keep_users]
+        bc.user_degree_arr = np.asarray(bc._B.sum(axis=1)).ravel()
+        bc.item_degree_arr = self.item_degree_arr[keep_items]
+        bc.clear_cache()
+        return bc
+
+    def __getstate__(self):
+        # Keep the caller's dataframe out of pickles (e.g. joblib workers); the
+        # matrix, labels and codes are all that is needed there
+        state = self.__dict__.copy()
+        state["_source"] = None
+        return state
+
+    def clear_cache(self):
+        """Releases the lazily computed graph, projections and partitions"""
+        self._G: Optional[nx.Graph] = None
+        self._proj_items: Optional[sp.csr_matrix] = None
+        self._proj_users: Optional[sp.csr_matrix] = None
+        self._partitions_items: dict[float, tuple[np.ndarray, float]] = {}
+        self._partitions_users: dict[float, tuple[np.ndarray, float]] = {}
+
+    @property
+    def user_labels(self) -> np.ndarray:
+        """User labels, indexed by user code"""
+        return self._u_labels
+
+    @property
+    def item_labels(self) -> np.ndarray:
+        """Item labels, indexed by item code"""
+        return self._i_labels
+
+    @property
+    def user_degree(self) -> dict[Union[int, str], int]:
+        """Degree of each user, keyed by label"""
+        return dict(zip(self._u_labels.tolist(), self.user_degree_arr.tolist()))
+
+    @property
+    def item_degree(self) -> dict[Union[int, str], int]:
+        """Degree of each item, keyed by label"""
+        return dict(zip(self._i_labels.tolist(), self.item_degree_arr.tolist()))
+
+    def project_onto_items(self) -> sp.csr_matrix:
+        """Returns the weighted item projection as a sparse adjacency matrix.
+
+        Row and column k correspond to the item item_labels[k].
+        """
+        if self._proj_items is None:
+            logger.debug("Starting weighted projection...")
+            start = time.time()
+            self._proj_items = _weighted_projection(self._B.T.tocsr())
+            logger.debug("Finished weighted projection in %s", time.time() - start)
+        return self._proj_items
+
+    def project_onto_users(self) -> sp.csr_matrix:
+        """Returns the weighted user projection as a sparse adjacency matrix.
+
+        Row and column k correspond to the user user_labels[k].
+        """
+        if self._proj_users is None:
+            logger.debug("Starting weighted projection...")
+            start = time.time()
+            self._proj_users = _weighted_projection(self._B)
+            logger.debug("Finished weighted projection in %s", time.time() - start)
+        return self._proj_users
+
+    def _partition_items(self, resolution: float) -> tuple[np.ndarray, float]:
+        if resolution not in self._partitions_items:
+            logger.debug(
+                "Starting partition of items with resolution %s...", resolution
+            )
+            start = time.time()
+            self._partitions_items[resolution] = _partition(
+                self.project_onto_items(), resolution
+            )
+            logger.debug("Finished partition in %s", time.time() - start)
+        return self._partitions_items[resolution]
+
+    def _partition_users(self, resolution: float) -> tuple[np.ndarray, float]:
+        if resolution not in self._partitions_users:
+            logger.debug(
+                "Starting partition of users with resolution %s...", resolution
+            )
+            start = time.time()
+            self._partitions_users[resolution] = _partition(
+                self.project_onto_users(), resolution
+            )
+            logger.debug("Finished partition in %s", time.time() - start)
+        return self._partitions_users[resolution]
 
-    @cache
     def partition_items(self, resolution=1.0) -> dict[Union[int, str], int]:
-        print(f"Starting partition of items with resolution {resolution}...")
-        start = time.time()
-        projected = self.project_onto_items()
-        partition = community_louvain.best_partition(
-            projected, weight="weight", resolution=resolution
-        )
-        print(f"Finished partition in {time.time() - start}")
-        return partition
+        membership, _ = self._partition_items(resolution)
+        return dict(zip(self._i_labels.tolist(), membership.tolist()))
 
-    @cache
     def partition_users(self, resolution=1.0) -> dict[Union[int, str], int]:
-        print(f"Starting partition of users with resolution {resolution}...")
-        start = time.time()
-        projected = self.project_onto_users()
-        partition = community_louvain.best_partition(
-            projected, weight="weight", resolution=resolution
-        )
-        print(f"Finished partition in {time.time() - start}\n")
-        return partition
+        membership, _ = self._partition_users(resolution)
+        return dict(zip(self._u_labels.tolist(), membership.tolist()))
+
+    def modularity_items(self, resolution=1.0) -> float:
+        """Modularity of the item partition found at this resolution"""
+        _, mod = self._partition_items(resolution)
+        if np.isnan(mod):
+            raise ValueError("A graph without link has an undefined modularity")
+        return mod
+
+    def modularity_users(self, resolution=1.0) -> float:
+        """Modularity of the user partition found at this resolution"""
+        _, mod = self._partition_users(resolution)
+        if np.isnan(mod):
+            raise ValueError("A graph without link has an undefined modularity")
+        return mod
 
     # TODO: Make this describe function work with any graph
     def describe_bipartite(self):
-        print(f"Total # of edges (interactions): {len(self._df)}\n")
+        num_users, num_items = self._B.shape
+        total_weight = self._B.sum()
+        print(f"Total # of edges (interactions): {total_weight}\n")
 
-        print(f"# of unique {self.user_key}: {len(self.user_degree)}")
-        print(f"# of unique {self.item_key}: {len(self.item_degree)}")
-        assert (
-            len(self.user_degree) + len(self.item_degree) == self._G.number_of_nodes()
-        )
-        print(f"# of unique edges: {self._G.number_of_edges()}\n")
+        print(f"# of unique {self.user_key}: {num_users}")
+        print(f"# of unique {self.item_key}: {num_items}")
+        print(f"# of unique edges: {self._B.nnz}\n")
+
+        print(f"Average {self.user_key} weighted degree: {total_weight / num_users}")
+        print(f"Average {self.item_key} weighted degree: {total_weight / num_items}")
+        assert self.user_degree_arr.sum() == self.item_degree_arr.sum() == total_weight
+        print(f"Average edge weight: {total_weight / self._B.nnz}\n")
 
-        print(
-            f"Average {self.user_key} weighted degree: {len(self._df) / len(self.user_degree)}"
+    def get_bipartite(self) -> nx.Graph:
+        """Returns the bipartite graph as a networkx graph"""
+        if self._G is not None:
+            return self._G
+        G = nx.Graph()
+        user_nodes = (
+            (user, {"origin": "user", "degree": degree})
+            for user, degree in zip(
+                self._u_labels.tolist(), self.user_degree_arr.tolist()
+            )
         )
-        print(
-            f"Average {self.item_key} weighted degree: {len(self._df) / len(self.item_degree)}"
+        item_nodes = (
+            (item, {"origin": "item", "degree": degree})
+            for item, degree in zip(
+                self._i_labels.tolist(), self.item_degree_arr.tolist()
+            )
         )
-        assert sum(self.user_degree.values()) == sum(self.item_degree.values())
-        print(
-            f"Average edge weight: {sum(self.user_degree.values()) / self._G.number_of_edges()}\n"
+        G.add_nodes_from(itertools.chain(user_nodes, item_nodes))
+
+        edges = self._B.tocoo()
+        G.add_weighted_edges_from(
+            zip(
+                self._u_labels[edges.row].tolist(),
+                self._i_labels[edges.col].tolist(),
+                edges.data.tolist(),
+            )
         )
+        self._G = G
+        return G
 
-    def get_bipartite(self) -> nx.Graph:
-        """Returns the underlying networkx graph"""
-        return self._G
+    def get_df(self) -> pd.DataFrame:
+        """Returns the rows of the original dataframe kept after filtering.
 
-    def get_df(self) -> nx.Graph:
-        """Returns the underlying dataframe"""
-        return self._df
+        The original dataframe is not pickled, so this raises ValueError on a
+        community that was unpickled (e.g. inside a joblib worker).
+        """
+        if self._source is None:
+            raise ValueError("The original dataframe is not kept when pickled")
+        return self._source.iloc[self._df.index]
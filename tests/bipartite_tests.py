@@ -1,5 +1,189 @@
+import pickle
+
+import networkx as nx  # type: ignore
+import numpy as np
+import pandas as pd  # type: ignore
+import pytest
+import scipy.sparse as sp  # type: ignore
+from networkx.algorithms import bipartite  # type: ignore
+
+import communitygraph.bipartite as community_bipartite  # type: ignore
+from communitygraph.bipartite import BipartiteCommunity  # type: ignore
+
 # List of Tests to Add
 
 # Filtering top K users / items
     # Make sure weights are appropriately adjusted
-# Testing small graph numerica values
\ No newline at end of file
+# Testing small graph numerica values
+
+@pytest.fixture
+def df() -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(
+        {
+            "user": [f"u{n}" for n in rng.integers(0, 60, 600)],
+            "item": [f"i{n}" for n in rng.integers(0, 25, 600)],
+        }
+    )
+    df.loc[::37, "user"] = None
+    df.loc[::41, "item"] = None
+    return df
+
+
+@pytest.fixture
+def blocks() -> pd.DataFrame:
+    """Disjoint blocks of users that all interact with the same 4 items"""
+    rows = [
+        (f"u{block}_{user}", f"i{block}_{item}")
+        for block, num_users in enumerate([5, 10, 15])
+        for user in range(num_users)
+        for item in range(4)
+    ]
+    return pd.DataFrame(rows, columns=["user", "item"])
+
+
+@pytest.fixture
+def biadjacency() -> sp.csr_matrix:
+    return sp.random(30, 12, density=0.2, format="csr", random_state=1)
+
+
+def expected_projection(B: sp.csr_matrix) -> sp.csr_matrix:
+    """Projects B onto its rows with networkx's weighted_projected_graph"""
+    rows = [f"r{n}" for n in range(B.shape[0])]
+    cols = [f"c{n}" for n in range(B.shape[1])]
+    G = nx.Graph()
+    G.add_nodes_from(rows + cols)
+    coo = B.tocoo()
+    G.add_edges_from((rows[r], cols[c]) for r, c in zip(coo.row, coo.col))
+    projected = bipartite.weighted_projected_graph(G, rows)
+    return nx.to_scipy_sparse_array(projected, nodelist=rows, weight="weight")
+
+
+def test_weighted_projection(biadjacency, monkeypatch):
+    monkeypatch.setattr(community_bipartite, "njit", None)
+    W = community_bipartite._weighted_projection(biadjacency)
+    assert (W != expected_projection(biadjacency)).nnz == 0
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 7, 64])
+@pytest.mark.parametrize("max_threads", [False, True])
+def test_numba_projection(biadjacency, chunk_size, max_threads):
+    numba = pytest.importorskip("numba")
+    num_threads = numba.get_num_threads()
+    if max_threads:
+        numba.set_num_threads(numba.config.NUMBA_NUM_THREADS)
+    try:
+        W = community_bipartite._numba_projection(biadjacency, chunk_size)
+    finally:
+        numba.set_num_threads(num_threads)
+    assert (W != expected_projection(biadjacency)).nnz == 0
+
+
+def test_missing_keys_are_dropped():
+    df = pd.DataFrame(
+        {
+            "user": ["a", "b", None, "c"],
+            "item": ["x", None, "y", "y"],
+            "rating": [1.0, None, 2.0, None],
+        }
+    )
+    bc = BipartiteCommunity(df, "user", "item", min_item_degree=None)
+    pd.testing.assert_frame_equal(bc.get_df(), df.iloc[[0, 3]])
+    assert bc.user_degree == {"a": 1, "c": 1}
+    assert bc.item_degree == {"x": 1, "y": 1}
+
+
+@pytest.mark.parametrize("use_leidenalg", [True, False])
+def test_partition_backends(blocks, use_leidenalg, monkeypatch):
+    if use_leidenalg:
+        pytest.importorskip("leidenalg")
+    else:
+        pytest.importorskip("community")
+        monkeypatch.setattr(community_bipartite, "leidenalg", None)
+    bc = BipartiteCommunity(blocks, "user", "item", min_item_degree=None)
+    partition = bc.partition_items()
+    assert set(partition) == set(blocks["item"])
+    for block in range(3):
+        assert len({partition[f"i{block}_{item}"] for item in range(4)}) == 1
+    assert len(set(partition.values())) == 3
+
+
+def test_partition_requires_a_backend(blocks, monkeypatch):
+    monkeypatch.setattr(community_bipartite, "leidenalg", None)
+    monkeypatch.setattr(community_bipartite, "community_louvain", None)
+    bc = BipartiteCommunity(blocks, "user", "item", min_item_degree=None)
+    with pytest.raises(ImportError):
+        bc.partition_items()
+
+
+def test_projection_labels(df):
+    bc = BipartiteCommunity(df, "user", "item", min_item_degree=None)
+    items = bc.item_labels.tolist()
+    projected = bipartite.weighted_projected_graph(bc.get_bipartite(), items)
+    expected = nx.to_scipy_sparse_array(projected, nodelist=items, weight="weight")
+    assert (bc.project_onto_items() != expected).nnz == 0
+
+
+@pytest.mark.parametrize("use_leidenalg", [True, False])
+def test_modularity_matches_louvain(df, use_leidenalg, monkeypatch):
+    community_louvain = pytest.importorskip("community.community_louvain")
+    if use_leidenalg:
+        pytest.importorskip("leidenalg")
+    else:
+        monkeypatch.setattr(community_bipartite, "leidenalg", None)
+    bc = BipartiteCommunity(df, "user", "item", min_item_degree=None)
+    partition = bc.partition_items()
+    projected = bipartite.weighted_projected_graph(
+        bc.get_bipartite(), list(partition)
+    )
+    assert bc.modularity_items() == pytest.approx(
+        community_louvain.modularity(partition, projected)
+    )
+
+
+def edge_weights(bc: BipartiteCommunity) -> dict:
+    """Maps each (user, item) label pair of the biadjacency matrix to its weight"""
+    edges = bc._B.tocoo()
+    users = bc.user_labels[edges.row].tolist()
+    items = bc.item_labels[edges.col].tolist()
+    return dict(zip(zip(users, items), edges.data.tolist()))
+
+
+@pytest.mark.parametrize("min_degree", [None, 0, 1, 20, 25, 30])
+def test_filter_items_matches_init(df, min_degree):
+    base = BipartiteCommunity(df, "user", "item", min_item_degree=None)
+    filtered = base.filter_items(min_degree)
+    expected = BipartiteCommunity(df, "user", "item", min_item_degree=min_degree)
+
+    assert edge_weights(filtered) == edge_weights(expected)
+    assert set(filtered.user_labels) == set(expected.user_labels)
+    assert set(filtered.item_labels) == set(expected.item_labels)
+    assert filtered.user_degree == expected.user_degree
+    assert filtered.item_degree == expected.item_degree
+    pd.testing.assert_frame_equal(filtered.get_df(), expected.get_df())
+
+
+@pytest.mark.parametrize("use_leidenalg", [True, False])
+def test_partition_without_edges(use_leidenalg, monkeypatch):
+    if use_leidenalg:
+        pytest.importorskip("leidenalg")
+    else:
+        pytest.importorskip("community")
+        monkeypatch.setattr(community_bipartite, "leidenalg", None)
+    df = pd.DataFrame({"user": ["a", "b", "c", "d"], "item": ["x", "y", "z", "z"]})
+    bc = BipartiteCommunity(df, "user", "item", min_item_degree=None)
+    assert set(bc.partition_items()) == {"x", "y", "z"}
+    with pytest.raises(ValueError):
+        bc.modularity_items()
+
+
+def test_pickle_drops_source(df):
+    df["rating"] = 1.0
+    bc = BipartiteCommunity(df, "user", "item", min_item_degree=20)
+    assert list(bc.get_df().columns) == ["user", "item", "rating"]
+
+    unpickled = pickle.loads(pickle.dumps(bc))
+    assert unpickled._source is None
+    assert edge_weights(unpickled) == edge_weights(bc)
+    with pytest.raises(ValueError):
+        unpickled.get_df()
@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd  # type: ignore
+import pytest
+
+from communitygraph.util import (  # type: ignore
+    label_df_partition,
+    optimize_modularity,
+)
+
+
+@pytest.fixture
+def blocks() -> pd.DataFrame:
+    """Disjoint blocks of users that all interact with the same 4 items"""
+    rows = [
+        (f"u{block}_{user}", f"i{block}_{item}")
+        for block, num_users in enumerate([5, 10, 15])
+        for user in range(num_users)
+        for item in range(4)
+    ]
+    return pd.DataFrame(rows, columns=["user", "item"])
+
+
+@pytest.fixture
+def interactions() -> pd.DataFrame:
+    return pd.DataFrame(
+        {"item": ["x", "y", "z", "x", "w"], "rating": [1, 2, 3, 4, 5]},
+        index=[10, 11, 12, 13, 14],
+    )
+
+
+@pytest.mark.parametrize("inplace", [False, True])
+def test_label_df_partition(interactions, inplace):
+    original = interactions.copy()
+    labelled = label_df_partition(
+        interactions, "item", {"x": 0, "y": 1, "z": 1}, inplace=inplace
+    )
+
+    # Rows whose key is missing from the partition are dropped
+    assert labelled.index.tolist() == [10, 11, 12, 13]
+    assert labelled["community"].tolist() == [0, 1, 1, 0]
+    assert labelled["community"].dtype == np.int32
+    assert labelled["rating"].tolist() == [1, 2, 3, 4]
+    pd.testing.assert_frame_equal(interactions, original)
+
+
+def test_label_df_partition_categorical(interactions):
+    interactions["item"] = interactions["item"].astype("category")
+    labelled = label_df_partition(interactions, "item", {"x": 0, "y": 1, "z": 1})
+    assert labelled.index.tolist() == [10, 11, 12, 13]
+    assert labelled["community"].tolist() == [0, 1, 1, 0]
+    assert labelled["community"].dtype == np.int32
+
+
+def test_optimize_modularity_parallel_matches_serial(blocks):
+    min_item_degree = [0, 10, 15]
+    resolution = [0.5, 1.0]
+    serial = optimize_modularity(
+        blocks, "user", "item", min_item_degree, resolution, debug=False, n_jobs=1
+    )
+    parallel = optimize_modularity(
+        blocks, "user", "item", min_item_degree, resolution, debug=False, n_jobs=2
+    )
+
+    assert list(serial) == [(d, r) for d in min_item_degree for r in resolution]
+    assert list(parallel) == list(serial)
+    assert list(parallel.values()) == pytest.approx(list(serial.values()))
@@ -1,13 +1,13 @@
-import contextlib
-import os
+import gc
 import time
 from collections import Counter
 
 # import community as community_louvain  # type: ignore
 import matplotlib.pyplot as plt  # type: ignore
 import networkx as nx  # type: ignore
+import numpy as np
 import pandas as pd  # type: ignore
-from community.community_louvain import modularity  # type: ignore
+from joblib import Parallel, delayed  # type: ignore
 
 from communitygraph.bipartite import BipartiteCommunity  # type: ignore
 
@@ -16,10 +16,12 @@ def label_df_partition(
     df: pd.DataFrame, col_name: str, partition: dict[str, int], inplace=False
 ) -> pd.DataFrame:
     """Labels the dataframe using the partition"""
+    communities = df[col_name].map(pd.Series(partition))
+    labelled = communities.notna()
+    df = df.loc[labelled]
     if not inplace:
         df = df.copy()
-    df = df[df[col_name].isin(partition)]
-    df["community"] = df[col_name].apply(lambda x: partition[x])
+    df["community"] = communities[labelled].astype(np.int32)
     return df
 
 
@@ -36,7 +38,29 @@ def plot_partition_distribution(partition: dict[str, int]) -> plt.Figure:
     return fig
 
 
-# TODO: When BipartiteCommunity is switched to logger, we no longer need context manager
+def _search_min_degree(
+    bc: BipartiteCommunity, resolution: list[float]
+) -> list[tuple[float, np.ndarray, float]]:
+    """Partitions the item projection of bc at each resolution.
+
+    Returns the modularity, community sizes and time taken for each resolution.
+    """
+    results = []
+    bc.project_onto_items()
+    for res in resolution:
+        start = time.time()
+        partition = bc.partition_items(resolution=res)
+        community_sizes = np.bincount(np.fromiter(partition.values(), dtype=np.int64))
+        curr_mod = bc.modularity_items(resolution=res)
+        results.append((curr_mod, community_sizes, time.time() - start))
+
+    # Projections can be much larger than the bipartite graph, so release them
+    # before this worker moves on to the next min_degree
+    bc.clear_cache()
+    gc.collect()
+    return results
+
+
 def optimize_modularity(
     df: pd.DataFrame,
     user_key: str,
@@ -44,30 +68,32 @@ def optimize_modularity(
     min_item_degree: list[int],
     resolution: list[float] = [1.0],
     debug=True,
+    n_jobs: int = -1,
 ) -> dict:
-    """2d grid search for best min_degree and resolution"""
-    df = df.copy()
+    """2d grid search for best min_degree and resolution.
+
+    Each min_degree is searched in its own process; n_jobs is passed to joblib.
+    """
     data = {}
 
     print("Starting search over: ")
     print(f" - min_item_degree: {min_item_degree}")
     print(f" - resolution: {resolution}\n")
 
-    iter = 1
-    for min_deg in min_item_degree:
-        # Don't show debug outputs for creating the community + projection
-        with open(os.devnull, "w") as f, contextlib.redirect_stdout(f):
-            bc = BipartiteCommunity(df, user_key, item_key, min_item_degree=min_deg)
-            projected = bc.project_onto_items()
-
-        for res in resolution:
-            start = time.time()
+    # Build the biadjacency matrix once, then filter it for each min_item_degree
+    base = BipartiteCommunity(df, user_key, item_key, min_item_degree=None)
 
-            # Don't show debut outputs for partitioning
-            with open(os.devnull, "w") as f, contextlib.redirect_stdout(f):
-                partition = bc.partition_items(resolution=res)
-                curr_mod = modularity(partition, projected)
+    # Results are consumed in order as each min_degree finishes
+    results = Parallel(n_jobs=n_jobs, backend="loky", return_as="generator")(
+        delayed(_search_min_degree)(base.filter_items(min_deg), resolution)
+        for min_deg in min_item_degree
+    )
 
+    iter = 1
+    for min_deg, min_deg_results in zip(min_item_degree, results):
+        for res, (curr_mod, community_sizes, elapsed) in zip(
+            resolution, min_deg_results
+        ):
             data[(min_deg, res)] = curr_mod
 
             if debug:
@@ -76,14 +102,14 @@ def optimize_modularity(
                     f"min_deg {min_deg}, resolution {res}",
                 )
                 print(f"Modularity: {curr_mod}")
-                community_sizes = Counter(partition.values())
-                num_nodes = sum(community_sizes.values())
+                num_nodes = community_sizes.sum()
                 unique_communities = len(community_sizes)
-                counts = sorted(community_sizes.values())
-                print(f"Median community size: {counts[len(counts)//2]}")
+                k = community_sizes.size // 2
+                median = int(np.partition(community_sizes, k)[k])
+                print(f"Median community size: {median}")
                 print(f"# communities: {unique_communities}")
                 print(f"# nodes: {num_nodes}")
-                print(f"Time taken: {time.time() - start}\n")
+                print(f"Time taken: {elapsed}\n")
             iter += 1
 
     return data